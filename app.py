@@ -6,18 +6,41 @@ Agora o n8n faz TUDO: conversa, agendamento, qualificação, banco de dados!
 """
 
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+import json
 import logging
 import os
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
 
-# Carregar variáveis de ambiente
-load_dotenv()
+# Carregar variáveis de ambiente (em produção o orquestrador já injeta o env)
+if os.getenv("ENVIRONMENT", "development") != "production":
+    load_dotenv()
+
+class OrjsonProvider(JSONProvider):
+    """Serialização JSON do Flask (jsonify) via orjson, com fallback no json."""
+
+    def dumps(self, obj, **kwargs):
+        try:
+            return orjson.dumps(obj).decode()
+        except orjson.JSONEncodeError:
+            # Ex.: inteiros acima de 64 bits vindos do n8n
+            return json.dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
-# Configuração de logging
-logging.basicConfig(level=logging.INFO)
+# Configuração de logging (LOG_LEVEL=WARNING em produção silencia o hot path)
+LOG_LEVEL = logging.getLevelNamesMapping().get(os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
 # Configurações
@@ -26,32 +49,89 @@ EVOLUTION_API_URL = os.getenv("EVOLUTION_API_URL")
 EVOLUTION_API_KEY = os.getenv("EVOLUTION_API_KEY")
 EVOLUTION_INSTANCE = os.getenv("EVOLUTION_INSTANCE_NAME")
 
+# Endpoints e headers fixos (montados uma vez no import)
+_EVOLUTION_SEND_TEXT_URL = f"{EVOLUTION_API_URL}/message/sendText/{EVOLUTION_INSTANCE}"
+_EVOLUTION_HEADERS = {
+    "Content-Type": "application/json",
+    "apikey": EVOLUTION_API_KEY
+}
+_N8N_MASTER_URL = f"{N8N_BASE_URL}/webhook/master_bot"
+
+# Sessão HTTP compartilhada (keep-alive) para Evolution API e n8n
+_http = requests.Session()
+_http_adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16,
+                            max_retries=Retry(total=2, backoff_factor=0.2))
+_http.mount("https://", _http_adapter)
+_http.mount("http://", _http_adapter)
+
+# Extratores de texto por messageType (um único lookup por mensagem)
+_TEXT_EXTRACTORS = {
+    'textMessage': lambda m: m.get('conversation'),
+    'conversation': lambda m: m.get('conversation'),
+    'extendedTextMessage': lambda m: (m.get('extendedTextMessage') or {}).get('text'),
+    'imageMessage': lambda m: (m.get('imageMessage') or {}).get('caption'),
+    'buttonsResponseMessage': lambda m: ((m.get('buttonsResponseMessage') or {}).get('selectedDisplayText')
+                                         or (m.get('buttonsResponseMessage') or {}).get('selectedButtonId')),
+    'listResponseMessage': lambda m: (((m.get('listResponseMessage') or {}).get('singleSelectReply') or {})
+                                      .get('selectedRowId')),
+}
+
+# Valores textuais de key.fromMe que indicam mensagem do próprio bot
+_TRUTHY_OWN = frozenset({"True", "true", "1"})
+
+# Deduplicação de reentregas da Evolution por data.key.id: ids em
+# processamento ficam em _IN_FLIGHT_IDS; ids já respondidos ficam num LRU
+# limitado em _SEEN_IDS.
+_SEEN_IDS = OrderedDict()
+_SEEN_IDS_MAX = 10_000
+_IN_FLIGHT_IDS = set()
+_SEEN_IDS_LOCK = threading.Lock()
+
+def _claim_message(message_id: str):
+    """
+    Reservar o id da mensagem para processamento.
+    
+    Retorna None se o id foi reservado, "duplicate" se a mensagem já foi
+    respondida ou "in_flight" se outra entrega ainda está em andamento.
+    """
+    with _SEEN_IDS_LOCK:
+        if message_id in _SEEN_IDS:
+            _SEEN_IDS.move_to_end(message_id)
+            return "duplicate"
+        if message_id in _IN_FLIGHT_IDS:
+            return "in_flight"
+        _IN_FLIGHT_IDS.add(message_id)
+        return None
+
+def _release_message(message_id: str, replied: bool):
+    """Liberar o id; só marca como respondido se a resposta foi enviada."""
+    with _SEEN_IDS_LOCK:
+        _IN_FLIGHT_IDS.discard(message_id)
+        if replied:
+            _SEEN_IDS[message_id] = None
+            if len(_SEEN_IDS) > _SEEN_IDS_MAX:
+                _SEEN_IDS.popitem(last=False)
+
 def send_whatsapp_message(number: str, message: str):
     """Enviar mensagem via Evolution API."""
     try:
-        url = f"{EVOLUTION_API_URL}/message/sendText/{EVOLUTION_INSTANCE}"
-        
         payload = {
             "number": number,
             "text": message
         }
         
-        headers = {
-            "Content-Type": "application/json",
-            "apikey": EVOLUTION_API_KEY
-        }
-        
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
+        response = _http.post(_EVOLUTION_SEND_TEXT_URL, json=payload,
+                              headers=_EVOLUTION_HEADERS, timeout=10)
         
         if response.status_code == 200:
-            logger.info(f"✅ Mensagem enviada para {number}")
+            logger.info("✅ Mensagem enviada para %s", number)
             return True
         else:
-            logger.error(f"❌ Erro ao enviar mensagem: {response.status_code}")
+            logger.error("❌ Erro ao enviar mensagem: %s", response.status_code)
             return False
             
     except Exception as e:
-        logger.error(f"💥 Erro no WhatsApp: {e}")
+        logger.error("💥 Erro no WhatsApp: %s", e)
         return False
 
 @app.route('/webhook/evolution', methods=['POST'])
@@ -62,28 +142,53 @@ def webhook_evolution():
     Apenas recebe a mensagem e manda para o n8n.
     O n8n faz TODO o resto!
     """
+    claimed_id = None
+    replied = False
     try:
-        data = request.json
-        logger.info(f"📨 Webhook recebido: {data}")
+        raw = request.get_data(cache=False)
+        try:
+            data = orjson.loads(raw) if raw else None
+        except orjson.JSONDecodeError:
+            data = None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📨 Webhook recebido: %s", raw[:500].decode('utf-8', 'replace'))
         
         # Extrair dados da mensagem
-        if not data or 'data' not in data:
+        message_data = data.get('data') if type(data) is dict else None
+        if type(message_data) is not dict:
             return jsonify({"status": "ignored", "reason": "no_data"}), 200
-            
-        message_data = data['data']
+        
+        key = message_data.get('key') or {}
+        
+        # Ignorar o eco das mensagens enviadas pelo próprio bot
+        own = key.get('fromMe')
+        if own is True or (type(own) is str and own in _TRUTHY_OWN):
+            return jsonify({"status": "ignored", "reason": "from_me"}), 200
         
         # Verificar se é mensagem de texto
-        if message_data.get('messageType') != 'textMessage':
+        extract_text = _TEXT_EXTRACTORS.get(message_data.get('messageType'))
+        if extract_text is None:
             return jsonify({"status": "ignored", "reason": "not_text"}), 200
         
+        # Ignorar reentregas do mesmo evento
+        message_id = key.get('id')
+        if message_id:
+            claim = _claim_message(message_id)
+            if claim == "duplicate":
+                return jsonify({"status": "ignored", "reason": "duplicate"}), 200
+            if claim == "in_flight":
+                # 503: a Evolution reenvia se a primeira entrega falhar
+                return jsonify({"status": "retry", "reason": "in_flight"}), 503
+            claimed_id = message_id
+        
         # Extrair informações
-        user_number = message_data.get('key', {}).get('remoteJid', '').replace('@s.whatsapp.net', '')
-        message_text = message_data.get('message', {}).get('conversation', '')
+        user_number = (key.get('remoteJid') or '').replace('@s.whatsapp.net', '')
+        message_text = extract_text(message_data.get('message') or {}) or ''
         
         if not user_number or not message_text:
             return jsonify({"status": "ignored", "reason": "missing_data"}), 200
         
-        logger.info(f"📱 Processando: {user_number} -> {message_text[:50]}...")
+        logger.info("📱 Processando: %s -> %.50s...", user_number, message_text)
         
         # 🚀 ENVIAR TUDO PARA O N8N MASTER!
         n8n_response = send_to_n8n_master(user_number, message_text)
@@ -91,6 +196,7 @@ def webhook_evolution():
         if n8n_response and 'reply' in n8n_response:
             # Enviar resposta via WhatsApp
             success = send_whatsapp_message(user_number, n8n_response['reply'])
+            replied = success
             
             return jsonify({
                 "status": "processed",
@@ -102,8 +208,11 @@ def webhook_evolution():
             return jsonify({"status": "error", "reason": "n8n_failed"}), 500
             
     except Exception as e:
-        logger.error(f"💥 Erro no webhook: {e}")
+        logger.error("💥 Erro no webhook: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
+    finally:
+        if claimed_id:
+            _release_message(claimed_id, replied)
 
 def send_to_n8n_master(user_number: str, message: str, current_state: str = "FREE"):
     """
@@ -117,8 +226,6 @@ def send_to_n8n_master(user_number: str, message: str, current_state: str = "FRE
     - Retorna resposta pronta
     """
     try:
-        url = f"{N8N_BASE_URL}/webhook/master_bot"
-        
         payload = {
             "user_number": user_number,
             "message": message,
@@ -126,20 +233,20 @@ def send_to_n8n_master(user_number: str, message: str, current_state: str = "FRE
             "timestamp": "2024-01-15T10:30:00Z"
         }
         
-        logger.info(f"🚀 Enviando para n8n master: {payload}")
+        logger.info("🚀 Enviando para n8n master: %s", payload)
         
-        response = requests.post(url, json=payload, timeout=30)
+        response = _http.post(_N8N_MASTER_URL, json=payload, timeout=30)
         
         if response.status_code == 200:
             result = response.json()
-            logger.info(f"✅ n8n master respondeu: {result}")
+            logger.info("✅ n8n master respondeu: %s", result)
             return result
         else:
-            logger.error(f"❌ n8n master erro: {response.status_code} - {response.text}")
+            logger.error("❌ n8n master erro: %s - %s", response.status_code, response.text)
             return None
             
     except Exception as e:
-        logger.error(f"💥 Erro ao chamar n8n master: {e}")
+        logger.error("💥 Erro ao chamar n8n master: %s", e)
         return None
 
 @app.route('/health', methods=['GET'])
@@ -176,12 +283,15 @@ def home():
     <p><strong>n8n URL:</strong> <a href="{}">{}</a></p>
     """.format(N8N_BASE_URL, N8N_BASE_URL)
 
+# Ponto de entrada WSGI único (Dockerfile: gunicorn app:application)
+application = app
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 8000))
     debug = os.getenv('FLASK_ENV') == 'development'
     
-    logger.info(f"🚀 Iniciando JustIA Bot 2.0 - n8n Centralized")
-    logger.info(f"🔗 n8n URL: {N8N_BASE_URL}")
-    logger.info(f"🌐 Porta: {port}")
+    logger.info("🚀 Iniciando JustIA Bot 2.0 - n8n Centralized")
+    logger.info("🔗 n8n URL: %s", N8N_BASE_URL)
+    logger.info("🌐 Porta: %s", port)
     
     app.run(host='0.0.0.0', port=port, debug=debug)
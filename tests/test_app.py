@@ -0,0 +1,206 @@
+"""Testes do webhook da Evolution (n8n e WhatsApp substituídos por fakes)."""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import app as bot
+
+NUMBER = "5511999999999"
+
+
+def _event(message_type="conversation", message=None, message_id="MSG-1", from_me=False):
+    return {
+        "data": {
+            "messageType": message_type,
+            "key": {"id": message_id, "fromMe": from_me, "remoteJid": f"{NUMBER}@s.whatsapp.net"},
+            "message": {"conversation": "oi"} if message is None else message,
+        }
+    }
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Respostas enviadas ao WhatsApp; o n8n fake ecoa o texto recebido."""
+    sent = []
+    monkeypatch.setattr(bot, "send_to_n8n_master", lambda number, text, *a: {"reply": f"ok:{text}"})
+    monkeypatch.setattr(bot, "send_whatsapp_message", lambda number, reply: sent.append((number, reply)) or True)
+    return sent
+
+
+@pytest.fixture
+def client(sent):
+    with bot._SEEN_IDS_LOCK:
+        bot._SEEN_IDS.clear()
+        bot._IN_FLIGHT_IDS.clear()
+    return bot.app.test_client()
+
+
+def _post(client, body):
+    data = body if isinstance(body, (bytes, str)) else json.dumps(body)
+    return client.post("/webhook/evolution", data=data, content_type="application/json")
+
+
+@pytest.mark.parametrize("message_type, message, text", [
+    ("textMessage", {"conversation": "oi"}, "oi"),
+    ("conversation", {"conversation": "oi"}, "oi"),
+    ("extendedTextMessage", {"extendedTextMessage": {"text": "olá"}}, "olá"),
+    ("imageMessage", {"imageMessage": {"caption": "foto do documento"}}, "foto do documento"),
+    ("buttonsResponseMessage", {"buttonsResponseMessage": {"selectedDisplayText": "Sim"}}, "Sim"),
+    ("buttonsResponseMessage", {"buttonsResponseMessage": {"selectedButtonId": "btn_1"}}, "btn_1"),
+    ("listResponseMessage", {"listResponseMessage": {"singleSelectReply": {"selectedRowId": "row_2"}}}, "row_2"),
+])
+def test_text_is_extracted_per_message_type(client, sent, message_type, message, text):
+    response = _post(client, _event(message_type, message))
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "processed"
+    assert sent == [(NUMBER, f"ok:{text}")]
+
+
+def test_image_without_caption_is_ignored(client, sent):
+    response = _post(client, _event("imageMessage", {"imageMessage": {}}))
+    assert response.get_json()["reason"] == "missing_data"
+    assert sent == []
+
+
+def test_unsupported_message_type_is_ignored(client, sent):
+    response = _post(client, _event("audioMessage", {"audioMessage": {}}))
+    assert response.get_json()["reason"] == "not_text"
+    assert sent == []
+
+
+@pytest.mark.parametrize("message_type, message", [
+    ("conversation", {"conversation": "eco"}),
+    ("extendedTextMessage", {"extendedTextMessage": {"text": "eco"}}),
+    ("imageMessage", {"imageMessage": {"caption": "eco"}}),
+])
+def test_own_messages_are_not_answered(client, sent, message_type, message):
+    response = _post(client, _event(message_type, message, from_me=True))
+    assert response.status_code == 200
+    assert response.get_json()["reason"] == "from_me"
+    assert sent == []
+
+
+@pytest.mark.parametrize("body", [b"", b"not json", b"{\"data\": "])
+def test_invalid_body_is_ignored(client, sent, body):
+    response = _post(client, body)
+    assert response.status_code == 200
+    assert response.get_json()["reason"] == "no_data"
+    assert sent == []
+
+
+def test_body_is_parsed_without_json_content_type(client, sent):
+    response = client.post("/webhook/evolution", data=json.dumps(_event()), content_type="text/plain")
+    assert response.get_json()["status"] == "processed"
+
+
+def test_answered_delivery_is_deduplicated(client, sent):
+    assert _post(client, _event()).get_json()["status"] == "processed"
+    again = _post(client, _event())
+    assert again.status_code == 200
+    assert again.get_json()["reason"] == "duplicate"
+    assert len(sent) == 1
+
+
+def test_retry_after_n8n_failure_is_processed(client, sent, monkeypatch):
+    monkeypatch.setattr(bot, "send_to_n8n_master", lambda *a: None)
+    first = _post(client, _event())
+    assert first.status_code == 500
+    assert first.get_json()["reason"] == "n8n_failed"
+
+    monkeypatch.setattr(bot, "send_to_n8n_master", lambda number, text, *a: {"reply": "ok"})
+    retry = _post(client, _event())
+    assert retry.get_json()["status"] == "processed"
+    assert sent == [(NUMBER, "ok")]
+
+
+def test_retry_after_error_before_reply_is_processed(client, sent, monkeypatch):
+    def boom(*a):
+        raise RuntimeError("n8n fora do ar")
+
+    monkeypatch.setattr(bot, "send_to_n8n_master", boom)
+    assert _post(client, _event()).status_code == 500
+
+    monkeypatch.setattr(bot, "send_to_n8n_master", lambda number, text, *a: {"reply": "ok"})
+    assert _post(client, _event()).get_json()["status"] == "processed"
+    assert sent == [(NUMBER, "ok")]
+
+
+def test_retry_after_error_past_reply_is_not_answered_again(client, sent, monkeypatch):
+    # A resposta sai, mas a serialização do retorno do webhook falha depois
+    monkeypatch.setattr(bot, "send_to_n8n_master", lambda *a: {"reply": "ok", "extra": object()})
+    assert _post(client, _event()).status_code == 500
+    assert sent == [(NUMBER, "ok")]
+
+    retry = _post(client, _event())
+    assert retry.get_json()["reason"] == "duplicate"
+    assert sent == [(NUMBER, "ok")]
+
+
+def test_retry_while_first_delivery_is_in_flight_is_retryable(client, sent, monkeypatch):
+    retries = []
+
+    def slow_failing_n8n(*a):
+        # Reentrega da Evolution chegando enquanto o n8n ainda processa
+        retries.append(_post(client, _event()))
+        return None
+
+    monkeypatch.setattr(bot, "send_to_n8n_master", slow_failing_n8n)
+    assert _post(client, _event()).status_code == 500
+    assert retries[0].status_code == 503
+    assert retries[0].get_json()["reason"] == "in_flight"
+
+    monkeypatch.setattr(bot, "send_to_n8n_master", lambda number, text, *a: {"reply": "ok"})
+    assert _post(client, _event()).get_json()["status"] == "processed"
+    assert sent == [(NUMBER, "ok")]
+
+
+def test_reply_with_values_orjson_rejects_is_still_serialized(client, sent, monkeypatch):
+    big = 2 ** 70
+    monkeypatch.setattr(bot, "send_to_n8n_master", lambda *a: {"reply": "ok", "protocolo": big})
+    response = _post(client, _event())
+    assert response.status_code == 200
+    assert response.get_json()["n8n_response"]["protocolo"] == big
+    assert sent == [(NUMBER, "ok")]
+
+
+@pytest.mark.parametrize("from_me", ["true", "True", "1"])
+def test_own_messages_flagged_as_strings_are_not_answered(client, sent, from_me):
+    response = _post(client, _event(from_me=from_me))
+    assert response.get_json()["reason"] == "from_me"
+    assert sent == []
+
+
+@pytest.mark.parametrize("from_me", [[1], {"x": 1}, "false", 0, None])
+def test_unexpected_from_me_values_are_processed(client, sent, from_me):
+    response = _post(client, _event(from_me=from_me))
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "processed"
+
+
+@pytest.mark.parametrize("name, level", [
+    ("warning", "30"),
+    ("DEBUG", "10"),
+    ("BASIC_FORMAT", "20"),
+    ("nao_existe", "20"),
+])
+def test_log_level_accepts_only_level_names(name, level):
+    env = {**os.environ, "LOG_LEVEL": name}
+    result = subprocess.run(
+        [sys.executable, "-c", "import app; print(app.LOG_LEVEL)"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=env, capture_output=True, text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == level
+
+
+@pytest.mark.parametrize("body", ["data", [1, 2], {}, {"data": None}, {"data": [1]}, {"data": "texto"}])
+def test_non_object_envelope_is_ignored(client, sent, body):
+    response = _post(client, json.dumps(body))
+    assert response.status_code == 200
+    assert response.get_json()["reason"] == "no_data"
+    assert sent == []